@@ -1,6 +1,12 @@
+import hashlib
 import json
+import logging
 import os
+import random
 import re
+import threading
+import uuid
+import zipfile
 import pandas as pd
 import streamlit as st
 from datetime import datetime, timedelta
@@ -9,12 +15,14 @@ from dotenv import load_dotenv
 from groq import Groq  
 from PIL import Image
 import io
+import tempfile
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 import base64
-from time import time
+from collections import deque
+from time import time, monotonic
 
 def load_templates():
     try:
@@ -41,19 +49,258 @@ def validate_date(date_obj):
 def validate_contact(number):
     return number if re.fullmatch(r"\d{10,12}", number) else None
 
-def generate_ai_leave_letter(data, faculty_df):
+GROQ_TIMEOUT_SECONDS = 8
+GROQ_COMPLETION_TOKENS = 600
+
+class GroqRateLimiter:
+    """Process-wide token buckets on Groq requests and tokens.
+
+    Waiting calls are served round-robin across sessions, so one session
+    cannot starve the others, and a call whose estimated wait exceeds its
+    budget is turned away instead of queued.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = monotonic()
+        self.queues = {}
+        self.order = deque()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+
+    def _position(self, ticket):
+        position = 0
+        for index in range(max(len(queue) for queue in self.queues.values())):
+            for session_id in self.order:
+                queue = self.queues[session_id]
+                if index < len(queue):
+                    position += 1
+                    if queue[index] is ticket:
+                        return position
+        return position
+
+    def _estimated_wait(self, position, tokens):
+        request_wait = (position - self.requests) / self.request_rate
+        token_wait = (position * tokens - self.tokens) / self.token_rate
+        return max(0.0, request_wait, token_wait)
+
+    def _remove(self, session_id, ticket, served=False):
+        queue = self.queues[session_id]
+        queue.remove(ticket)
+        if not queue:
+            self.order.remove(session_id)
+            del self.queues[session_id]
+        elif served:
+            # A session that was just served goes to the back of the rotation
+            self.order.remove(session_id)
+            self.order.append(session_id)
+        self.condition.notify_all()
+
+    def acquire(self, session_id, tokens, max_wait, on_wait=None):
+        """Block until the call may go to Groq and return the tokens charged for it.
+
+        Returns 0 instead if the call would wait longer than max_wait.
+        """
+        tokens = min(tokens, self.token_capacity)
+        ticket = object()
+        deadline = monotonic() + max_wait
+
+        with self.condition:
+            self.queues.setdefault(session_id, deque()).append(ticket)
+            if session_id not in self.order:
+                self.order.append(session_id)
+
+        try:
+            while True:
+                with self.condition:
+                    self._refill()
+                    position = self._position(ticket)
+                    wait = self._estimated_wait(position, tokens)
+                    if position == 1 and self.requests >= 1 and self.tokens >= tokens:
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        self._remove(session_id, ticket, served=True)
+                        return tokens
+                    if monotonic() + wait > deadline:
+                        self._remove(session_id, ticket)
+                        return 0
+                    self.condition.wait(timeout=min(max(wait, 0.05), 1.0))
+                if on_wait:
+                    on_wait(position, wait)
+        except BaseException:
+            # Streamlit interrupts a rerun or closed tab by raising from on_wait;
+            # drop the ticket so it does not block every other session
+            with self.condition:
+                self._remove(session_id, ticket)
+            raise
+
+    def record_usage(self, charged_tokens, actual_tokens):
+        """Correct the token bucket once the real usage of a call is known"""
+        with self.condition:
+            self.tokens = min(self.token_capacity, self.tokens + charged_tokens - actual_tokens)
+            self.condition.notify_all()
+
+@st.cache_resource
+def get_groq_limiter():
     load_dotenv()
-    api_key = os.getenv("GROQ_API_KEY")
-    
-    if not api_key:
-        return "❌ Error: Missing GROQ API Key!"
-    
-    client = Groq(api_key=api_key)
-    
-    faculty_designation = ""
+    return GroqRateLimiter(
+        int(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30")),
+        int(os.getenv("GROQ_TOKENS_PER_MINUTE", "6000"))
+    )
+
+def get_session_id():
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+# Offline composer: keywords used to classify the reason, and the phrase bank
+# each category draws from. {reason} is the student's own description.
+REASON_KEYWORDS = {
+    "illness": ["fever", "flu", "sick", "ill", "illness", "cold", "cough", "unwell", "hospital", "medical",
+                "doctor", "surgery", "injury", "injured", "headache", "infection", "covid", "health", "treatment"],
+    "bereavement": ["death", "died", "funeral", "passed away", "demise", "bereavement", "expired"],
+    "family": ["wedding", "marriage", "family function", "function", "ceremony", "engagement", "baptism",
+               "housewarming", "reception"],
+    "event": ["hackathon", "ideathon", "competition", "contest", "fest", "techfest", "workshop", "seminar",
+              "conference", "symposium", "event", "presentation", "exhibition", "expo", "nss", "ncc", "camp"],
+    "sports": ["sports", "match", "tournament", "athletics", "championship"],
+    "exam": ["exam", "examination", "test", "gate", "nptel", "entrance"],
+    "interview": ["interview", "placement", "recruitment", "campus drive"],
+}
+
+# Someone other than the student; the illness, exam, interview, sports and
+# event phrases would then describe the wrong person
+OTHER_PERSON_KEYWORDS = ["father", "mother", "parent", "dad", "mom", "grandfather", "grandmother", "grandparent",
+                         "sister", "brother", "son", "daughter", "uncle", "aunt", "cousin", "friend", "relative",
+                         "wife", "husband", "neighbour", "neighbor"]
+
+PHRASE_BANK = {
+    "illness": {
+        "subject": ["Request for Medical Leave", "Request for Leave on Health Grounds"],
+        "opening": [
+            "I am writing to request leave {period} as I am unwell and unable to attend classes.",
+            "I would like to inform you that I have been unwell and therefore request leave {period}.",
+            "Owing to my poor health, I kindly request you to grant me leave {period}.",
+        ],
+        "detail": [
+            "{reason} I am therefore unable to attend classes during this period.",
+            "{reason} As a result, I will not be able to participate in the academic activities during this period.",
+        ],
+    },
+    "bereavement": {
+        "subject": ["Request for Leave Due to Bereavement", "Request for Leave on Account of a Death in the Family"],
+        "opening": [
+            "With deep regret, I wish to inform you of a bereavement in my family and request leave {period}.",
+            "I am writing to request leave {period} owing to the sad demise of a family member.",
+        ],
+        "detail": [
+            "{reason} I need to be with my family during this time.",
+            "{reason} I will therefore be unable to attend classes during this period.",
+        ],
+    },
+    "family": {
+        "subject": ["Request for Leave Due to Family Function", "Request for Leave to Attend a Family Function"],
+        "opening": [
+            "I am writing to request leave {period} to attend a family function.",
+            "I kindly request you to grant me leave {period} as I need to be present for a family occasion.",
+            "I would like to request leave {period} on account of a family function.",
+        ],
+        "detail": [
+            "{reason} I will therefore be unable to attend classes during this period.",
+            "{reason} I kindly request you to consider my absence during these days.",
+        ],
+    },
+    "event": {
+        "subject": ["Request for Duty Leave to Attend an Event", "Request for Duty Leave for Participation in an Event"],
+        "opening": [
+            "I am writing to request duty leave {period} to participate in an event.",
+            "I kindly request you to grant me duty leave {period} so that I may take part in an event.",
+            "I would like to request duty leave {period} for my participation in an event.",
+        ],
+        "detail": [
+            "{reason} I will therefore be unable to attend classes during this period.",
+            "{reason} I kindly request you to consider my absence during these days.",
+        ],
+    },
+    "sports": {
+        "subject": ["Request for Duty Leave for Sports Participation", "Request for Leave to Participate in a Sports Event"],
+        "opening": [
+            "I am writing to request duty leave {period} to take part in a sports event.",
+            "I kindly request you to grant me leave {period} as I will be participating in a sports event.",
+        ],
+        "detail": [
+            "{reason} I will therefore be unable to attend classes during this period.",
+            "{reason} I kindly request you to consider my absence during these days.",
+        ],
+    },
+    "exam": {
+        "subject": ["Request for Leave to Attend an Examination", "Request for Leave to Appear for an Examination"],
+        "opening": [
+            "I am writing to request leave {period} as I have to appear for an examination.",
+            "I kindly request you to grant me leave {period} to attend an examination.",
+        ],
+        "detail": [
+            "{reason} I will therefore be unable to attend classes during this period.",
+            "{reason} I kindly request you to consider my absence during these days.",
+        ],
+    },
+    "interview": {
+        "subject": ["Request for Leave to Attend an Interview", "Request for Leave for an Interview"],
+        "opening": [
+            "I am writing to request leave {period} as I have to attend an interview.",
+            "I kindly request you to grant me leave {period} to attend an interview.",
+        ],
+        "detail": [
+            "{reason} I will therefore be unable to attend classes during this period.",
+            "{reason} I kindly request you to consider my absence during these days.",
+        ],
+    },
+    "general": {
+        "subject": ["Request for Leave", "Application for Leave"],
+        "opening": [
+            "I am writing to request leave {period} due to an unavoidable reason.",
+            "I kindly request you to grant me leave {period} as I will be unable to attend classes.",
+            "I would like to request leave {period} for the reason mentioned below.",
+        ],
+        "detail": [
+            "{reason} I will not be able to attend classes during this period.",
+            "{reason} I therefore request you to consider my absence during these days.",
+        ],
+    },
+    "assurance": [
+        "I assure you that I will catch up on all the lectures and assignments that I miss during my absence.",
+        "I will make up for the missed classes and complete all pending assignments upon my return.",
+        "I will stay in touch with my classmates and ensure that my studies do not suffer.",
+    ],
+    "request": [
+        "Kindly consider my request and grant me leave for the mentioned period.",
+        "I humbly request you to grant me leave for the above-mentioned days.",
+        "I would be grateful if you could grant me leave for the said period.",
+    ],
+}
+
+# Per-student letters are written once with these in place of the student's
+# name and year, then filled in for each student
+STUDENT_NAME_PLACEHOLDER = "[STUDENT_NAME]"
+STUDENT_YEAR_PLACEHOLDER = "[STUDENT_YEAR]"
+
+FIRST_PERSON_WORDS = {"i", "i'm", "i've", "i'll", "im", "we", "we're", "we've", "we'll"}
+
+def get_recipient_details(data, faculty_df):
     recipient_line = ""
     sir_madam = ""
-    
+
     if data['subto'] == "Principal":
         recipient_line = "The Principal"
         sir_madam = "Sir/Madam"
@@ -63,7 +310,118 @@ def generate_ai_leave_letter(data, faculty_df):
             faculty_designation = faculty_info.iloc[0]['Designation']
             recipient_line = f"{data['subto']}\n{faculty_designation}\n{faculty_info.iloc[0]['Department']}"
             sir_madam = "Sir/Madam"
-    
+
+    return recipient_line, sir_madam
+
+def get_reason_text(data):
+    """Return the student's reason without the appended list of additional students"""
+    reason = data.get('extra_details', '') or ''
+    return reason.split("Additional students:")[0].strip()
+
+def mentions(reason, word):
+    # Also match plurals, e.g. "exams", "matches"
+    return re.search(rf"\b{re.escape(word)}(?:e?s)?\b", reason) is not None
+
+def classify_reason(reason):
+    """Return the phrase bank category for a reason, or "general" when unsure"""
+    reason = reason.lower()
+    scores = {}
+    for category, keywords in REASON_KEYWORDS.items():
+        hits = sum(1 for word in keywords if mentions(reason, word))
+        if hits:
+            scores[category] = hits
+    if not scores:
+        return "general"
+    category = max(scores, key=scores.get)
+    if category not in ("bereavement", "family") and any(mentions(reason, word) for word in OTHER_PERSON_KEYWORDS):
+        return "general"
+    return category
+
+def compose_local_leave_letter(data, faculty_df, variation=0):
+    """Compose a formal leave letter offline from the phrase bank.
+
+    Each variation picks a different opening line, so "Regenerate" never
+    returns the same letter twice in a row.
+    """
+    recipient_line, sir_madam = get_recipient_details(data, faculty_df)
+    reason = get_reason_text(data)
+    category = classify_reason(reason)
+    phrases = PHRASE_BANK[category]
+    rng = random.Random(f"{data.get('user', '')}-{category}-{variation}")
+
+    if data['start_date'] == data['end_date']:
+        period = f"on {data['start_date']}"
+    else:
+        period = f"from {data['start_date']} to {data['end_date']}"
+
+    if reason:
+        if reason[-1] not in ".!?":
+            reason += "."
+        first_word = reason.split()[0]
+        if first_word.lower().strip(",.") in FIRST_PERSON_WORDS:
+            # Already a sentence about the student, e.g. "I have fever"
+            reason = reason[0].upper() + reason[1:]
+        else:
+            if first_word[1:] == first_word[1:].lower() and first_word != "I":
+                reason = reason[0].lower() + reason[1:]
+            reason = f"The reason for my absence is {reason}"
+        detail = rng.choice(phrases["detail"]).format(reason=reason)
+    else:
+        detail = ""
+
+    opening = phrases["opening"][variation % len(phrases["opening"])].format(period=period)
+    introduction = f"I am {data['user']}, a {data['year_of_study']} student of {data['programme']} in the {data['department']} Department."
+    # Like the Groq prompt, name up to two other students in the body; larger
+    # groups are listed only in the table
+    others = data.get('additional_students', [])
+    if 0 < len(others) <= 2:
+        names = " and ".join(f"{student['name']} ({student['year']})" for student in others)
+        opening += f" This request is also made on behalf of my fellow students {names}."
+    paragraphs = [
+        f"{introduction} {opening}",
+        detail,
+        f"{rng.choice(PHRASE_BANK['assurance'])} {rng.choice(PHRASE_BANK['request'])}",
+    ]
+    body = "\n\n".join(p for p in paragraphs if p)
+
+    return (
+        f"From:\n"
+        f"{data['user']}\n"
+        f"{data['year_of_study']} {data['programme']} ({data['department']})\n"
+        f"St. Joseph's College of Engineering and Technology\n"
+        f"Palai\n\n"
+        f"To:\n"
+        f"{recipient_line}\n"
+        f"St. Joseph's College of Engineering and Technology\n"
+        f"Palai\n\n"
+        f"Date: {datetime.now().strftime('%d-%m-%Y')}\n\n"
+        f"Subject: {rng.choice(phrases['subject'])}\n\n"
+        f"Respected {sir_madam or 'Sir/Madam'},\n\n"
+        f"{body}\n\n"
+        f"Thanking you,\n\n"
+        f"Yours faithfully,\n"
+        f"{data['user']}"
+    )
+
+def compose_offline_fallback(data, faculty_df, variation, cause):
+    st.info(f"⚡ {cause}, so this letter was written offline instead of by AI.")
+    return compose_local_leave_letter(data, faculty_df, variation)
+
+def generate_ai_leave_letter(data, faculty_df, variation=0, extra_instructions=""):
+    reason = get_reason_text(data)
+    if data.get('fast_compose') and classify_reason(reason) != "general":
+        return compose_local_leave_letter(data, faculty_df, variation)
+
+    load_dotenv()
+    api_key = os.getenv("GROQ_API_KEY")
+
+    if not api_key:
+        return compose_offline_fallback(data, faculty_df, variation, "The AI service is not configured")
+
+    client = Groq(api_key=api_key, timeout=GROQ_TIMEOUT_SECONDS, max_retries=0)
+
+    recipient_line, sir_madam = get_recipient_details(data, faculty_df)
+
     if 'additional_students' in data and len(data.get('additional_students', [])) > 2:
         prompt = f"""
         Write a formal leave letter using the following format:
@@ -112,7 +470,30 @@ def generate_ai_leave_letter(data, faculty_df):
 
         Format it professionally with a polite tone in 2-3 paragraphs as it is given to college and include proper closing with Thanking you and Yours faithfully. In the closing section, mention only the main student's name without department and college name.
         """
+
+    if extra_instructions:
+        prompt += f"""
+        {extra_instructions}
+        """
     
+    # Wait our turn for Groq; if the queue is too long, compose offline instead
+    limiter = get_groq_limiter()
+    estimated_tokens = len(prompt) // 4 + GROQ_COMPLETION_TOKENS
+    queue_status = st.empty()
+
+    def show_queue_position(position, wait):
+        queue_status.info(f"⏳ You are #{position} in the AI queue (about {int(wait) + 1}s)")
+
+    charged_tokens = limiter.acquire(
+        get_session_id(),
+        estimated_tokens,
+        float(os.getenv("GROQ_MAX_QUEUE_WAIT", "10")),
+        show_queue_position
+    )
+    queue_status.empty()
+    if not charged_tokens:
+        return compose_offline_fallback(data, faculty_df, variation, "The AI queue is too long right now")
+
     try:
         response = client.chat.completions.create(
             messages=[
@@ -121,10 +502,39 @@ def generate_ai_leave_letter(data, faculty_df):
             ],
             model="llama-3.3-70b-versatile"
         )
-        
-        return response.choices[0].message.content if response.choices else "❌ AI Response Error!"
-    except Exception as e:
-        return f"❌ Error: {str(e)}"
+
+        if response.usage:
+            limiter.record_usage(charged_tokens, response.usage.total_tokens)
+        if response.choices and response.choices[0].message.content:
+            return response.choices[0].message.content
+        logging.warning("Groq returned an empty leave letter")
+    except Exception:
+        logging.exception("Groq request failed")
+    # Groq is down, slow or returned nothing: fall back to the offline composer
+    return compose_offline_fallback(data, faculty_df, variation, "The AI service did not respond")
+
+def generate_student_letter_template(data, faculty_df, variation=0):
+    """Write one AI letter with placeholders for the student's name and year"""
+    placeholder_data = {key: value for key, value in data.items() if key not in ('additional_students', 'additional_signatures')}
+    placeholder_data.update(
+        user=STUDENT_NAME_PLACEHOLDER,
+        year_of_study=STUDENT_YEAR_PLACEHOLDER,
+        extra_details=get_reason_text(data)
+    )
+    letter = generate_ai_leave_letter(
+        placeholder_data,
+        faculty_df,
+        variation,
+        f"Write {STUDENT_NAME_PLACEHOLDER} and {STUDENT_YEAR_PLACEHOLDER} exactly as given wherever the student's name and year of study appear."
+    )
+    if STUDENT_NAME_PLACEHOLDER not in letter or STUDENT_YEAR_PLACEHOLDER not in letter:
+        # The model dropped a placeholder; the offline composer always keeps them
+        letter = compose_local_leave_letter(placeholder_data, faculty_df, variation)
+    return letter
+
+def fill_student_placeholders(letter, student):
+    return letter.replace(STUDENT_NAME_PLACEHOLDER, student['name']).replace(STUDENT_YEAR_PLACEHOLDER, student['year'])
+
 #CSS for buttons
 st.markdown("""
 <style>
@@ -182,7 +592,7 @@ def chat_interface():
             
             if user_choice == "Yes":
                 st.write("Enter additional students' details:")
-                num_students = st.number_input("Number of additional students", min_value=1, max_value=5, value=1)
+                num_students = st.number_input("Number of additional students", min_value=1, max_value=50, value=1)
                 
                 additional_students = []
                 for i in range(num_students):
@@ -379,6 +789,7 @@ def chat_interface():
         else:
             st.session_state.leave_data["template"] = "AI-generated"
             st.session_state.leave_data["extra_details"] = st.text_area("📝 Describe your reason:")
+            st.session_state.leave_data["fast_compose"] = st.checkbox("⚡ Instant offline letter for common reasons", value=True)
 
         # Main student signature
         signature_path = st.file_uploader("✍️ Upload your signature (optional)", type=["png", "jpg", "jpeg"], key="main_signature")
@@ -396,6 +807,11 @@ def chat_interface():
                 if sig:
                     signatures[student['name']] = sig
             st.session_state.leave_data['additional_signatures'] = signatures
+            st.session_state.leave_data['letter_format'] = st.radio(
+                "🗂️ Letter format:",
+                ["One combined letter", "One letter per student (ZIP)", "One letter per student (merged PDF)"],
+                key="letter_format_radio"
+            )
 
         cols = st.columns([1, 3, 1])
         with cols[0]:
@@ -408,8 +824,139 @@ def chat_interface():
 
     return None, None
 
+def format_size(num_bytes):
+    if num_bytes < 1024:
+        return f"{num_bytes} B"
+    return f"{num_bytes / 1024:.1f} KB"
+
+@st.cache_data(max_entries=256)
+def prepare_signature(image_bytes):
+    """Flatten a signature onto white and shrink it to a small PNG"""
+    signature_img = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+    background = Image.new("RGBA", signature_img.size, "white")
+    signature_img = Image.alpha_composite(background, signature_img).convert("RGB")
+    signature_img = signature_img.resize((50, 20), Image.LANCZOS)
+    buffer = io.BytesIO()
+    signature_img.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def add_signature(pdf, signature, x, y):
+    image_bytes = signature.getvalue() if hasattr(signature, 'getvalue') else signature.read()
+    digest = hashlib.sha1(image_bytes).hexdigest()
+    # FPDF caches images by name, so naming the file by content embeds
+    # identical signatures once per PDF
+    temp_path = os.path.join(tempfile.gettempdir(), f"dutyfree_{id(pdf)}_{digest}.png")
+    if temp_path in pdf.images:
+        pdf.image(temp_path, x=x, y=y, w=30, h=8)
+        return
+    with open(temp_path, "wb") as file:
+        file.write(prepare_signature(image_bytes))
+    try:
+        pdf.image(temp_path, x=x, y=y, w=30, h=8)
+    finally:
+        os.remove(temp_path)
+
+def render_leave_letter(pdf, letter_content, data, signature_path=None, sign_above_name=False):
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+
+    # Add the letter content
+    if sign_above_name and signature_path:
+        # Per-student letters have no table, so the signature goes between
+        # the closing and the student's name
+        closing, name_line = letter_content.rstrip().rsplit("\n", 1)
+        pdf.multi_cell(0, 8, closing)
+        if pdf.get_y() + 18 > pdf.page_break_trigger:
+            pdf.add_page()
+        sig_y = pdf.get_y() + 1
+        add_signature(pdf, signature_path, pdf.get_x(), sig_y)
+        pdf.set_y(sig_y + 9)
+        pdf.multi_cell(0, 8, name_line)
+    else:
+        pdf.multi_cell(0, 8, letter_content)
+
+    if 'additional_students' in data:
+        pdf.ln(10)
+        pdf.set_font("Arial", 'B', 12)
+        pdf.cell(0, 10, "Student Details:", ln=True)
+        pdf.ln(5)
+
+        # Table settings
+        col_widths = [70, 60, 60]
+        row_height = 10
+
+        pdf.set_font("Arial", 'B', 10)
+        pdf.set_fill_color(200, 200, 200)
+
+        pdf.cell(col_widths[0], row_height, "Name", 1, 0, 'C', 1)
+        pdf.cell(col_widths[1], row_height, "Year of Study", 1, 0, 'C', 1)
+        pdf.cell(col_widths[2], row_height, "Signature", 1, 1, 'C', 1)
+
+        pdf.set_font("Arial", '', 10)
+
+        pdf.cell(col_widths[0], row_height, data['user'], 1, 0, 'L')
+        pdf.cell(col_widths[1], row_height, data['year_of_study'], 1, 0, 'C')
+        sig_cell_y = pdf.get_y()
+        pdf.cell(col_widths[2], row_height, "", 1, 1, 'C')
+
+        #main signature
+        if signature_path:
+            add_signature(pdf, signature_path, pdf.get_x() + 145, sig_cell_y)
+
+        for student in data['additional_students']:
+            pdf.cell(col_widths[0], row_height, student['name'], 1, 0, 'L')
+            pdf.cell(col_widths[1], row_height, student['year'], 1, 0, 'C')
+            sig_cell_y = pdf.get_y()
+            pdf.cell(col_widths[2], row_height, "", 1, 1, 'C')  # Empty cell for signature
+
+            # Addl signatures
+            sig_path = data.get('additional_signatures', {}).get(student['name'])
+            if sig_path:
+                add_signature(pdf, sig_path, pdf.get_x() + 145, sig_cell_y)
+
+def build_leave_letter_pdf(letter_content, data, signature_path=None, sign_above_name=False):
+    pdf = FPDF()
+    render_leave_letter(pdf, letter_content, data, signature_path, sign_above_name)
+    return pdf.output(dest='S').encode('latin1')
+
+def iter_student_letters(student_letters, data, signature_path=None):
+    """Yield (letter, data, signature) for every student, each as a single-student letter"""
+    single_data = {key: value for key, value in data.items() if key not in ('additional_students', 'additional_signatures')}
+    students = [{'name': data['user'], 'year': data['year_of_study']}] + data['additional_students']
+    signatures = [signature_path] + [data.get('additional_signatures', {}).get(student['name']) for student in data['additional_students']]
+
+    for student_letter, student, signature in zip(student_letters, students, signatures):
+        yield student_letter, {**single_data, 'user': student['name'], 'year_of_study': student['year']}, signature
+
+def build_letters_zip(student_letters, data, signature_path=None):
+    """Render one PDF per student, writing each into the ZIP before rendering the next"""
+    archive_buffer = io.BytesIO()
+    with zipfile.ZipFile(archive_buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for index, (student_letter, student_data, signature) in enumerate(iter_student_letters(student_letters, data, signature_path), start=1):
+            file_name = f"{index:02d}_{student_data['user'].replace(' ', '_')}_leave_letter.pdf"
+            archive.writestr(file_name, build_leave_letter_pdf(student_letter, student_data, signature, sign_above_name=True))
+    return archive_buffer.getvalue()
+
+def build_merged_letters_pdf(student_letters, data, signature_path=None):
+    # One document, so identical signatures are embedded only once
+    pdf = FPDF()
+    for student_letter, student_data, signature in iter_student_letters(student_letters, data, signature_path):
+        render_leave_letter(pdf, student_letter, student_data, signature, sign_above_name=True)
+    return pdf.output(dest='S').encode('latin1')
+
+def build_letter_output(letter_content, data, signature_path=None, student_letters=None):
+    """Return the file to download and its name for the chosen letter format"""
+    base_name = f"{data['user'].replace(' ', '_')}_leave_letter"
+
+    if student_letters and data.get('letter_format') == "One letter per student (ZIP)":
+        return build_letters_zip(student_letters, data, signature_path), f"{base_name}s.zip"
+    if student_letters and data.get('letter_format') == "One letter per student (merged PDF)":
+        return build_merged_letters_pdf(student_letters, data, signature_path), f"{base_name}s.pdf"
+    return build_leave_letter_pdf(letter_content, data, signature_path), f"{base_name}.pdf"
+
 def generate_leave_letter(data, templates, faculty_df, signature_path=None):
     current_date = datetime.now().strftime("%d-%m-%Y")
+    per_student = 'additional_students' in data and data.get('letter_format', "One combined letter") != "One combined letter"
     
     template_data = {
         'user': data.get('user', ''),
@@ -445,7 +992,13 @@ def generate_leave_letter(data, templates, faculty_df, signature_path=None):
 
     # Generate letter content
     if data.get('template') == "AI-generated":
-        letter_content = generate_ai_leave_letter(data, faculty_df)
+        if 'pdf_generated' in st.session_state:
+            # Reruns reuse the letter already shown instead of calling Groq again
+            letter_content = st.session_state.letter_content
+        elif per_student:
+            letter_content = generate_student_letter_template(data, faculty_df)
+        else:
+            letter_content = generate_ai_leave_letter(data, faculty_df)
     else:
         try:
             template = templates.get(data['template'], '')
@@ -485,73 +1038,29 @@ def generate_leave_letter(data, templates, faculty_df, signature_path=None):
 
     letter_content = clean_text(letter_content)
 
-    # PDF Generation
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    
-    # Add the letter content
-    pdf.multi_cell(0, 8, letter_content)
-    
-    if 'additional_students' in data:
-        pdf.ln(10) 
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Student Details:", ln=True)
-        pdf.ln(5)
-        
-        # Table settings
-        col_widths = [70, 60, 60]
-        row_height = 10
-        
-        pdf.set_font("Arial", 'B', 10)
-        pdf.set_fill_color(200, 200, 200) 
-        
-        pdf.cell(col_widths[0], row_height, "Name", 1, 0, 'C', 1)
-        pdf.cell(col_widths[1], row_height, "Year of Study", 1, 0, 'C', 1)
-        pdf.cell(col_widths[2], row_height, "Signature", 1, 1, 'C', 1)
-        
-        pdf.set_font("Arial", '', 10)
-        
-        pdf.cell(col_widths[0], row_height, data['user'], 1, 0, 'L')
-        pdf.cell(col_widths[1], row_height, data['year_of_study'], 1, 0, 'C')
-        sig_cell_y = pdf.get_y()
-        pdf.cell(col_widths[2], row_height, "", 1, 1, 'C') 
-        
-        #main signature 
-        if signature_path:
-            signature_img = Image.open(signature_path)
-            signature_img = signature_img.resize((50, 20), Image.LANCZOS)
-            temp_path = "temp_signature.png"
-            signature_img.save(temp_path)
-            pdf.image(temp_path, x=pdf.get_x() + 145, y=sig_cell_y, w=30, h=8)
-            os.remove(temp_path)
-        
-        for student in data['additional_students']:
-            pdf.cell(col_widths[0], row_height, student['name'], 1, 0, 'L')
-            pdf.cell(col_widths[1], row_height, student['year'], 1, 0, 'C')
-            sig_cell_y = pdf.get_y()
-            pdf.cell(col_widths[2], row_height, "", 1, 1, 'C')  # Empty cell for signature
-            
-            # Addl signatures
-            if 'additional_signatures' in data and student['name'] in data['additional_signatures']:
-                sig_path = data['additional_signatures'][student['name']]
-                if sig_path:
-                    sig_img = Image.open(sig_path)
-                    sig_img = sig_img.resize((50, 20), Image.LANCZOS)
-                    temp_path = f"temp_sig_{student['name']}.png"
-                    sig_img.save(temp_path)
-                    pdf.image(temp_path, x=pdf.get_x() + 145, y=sig_cell_y, w=30, h=8)
-                    os.remove(temp_path)
+    def get_student_letters(content):
+        if not per_student:
+            return None
+        students = [{'name': data['user'], 'year': data['year_of_study']}] + data['additional_students']
+        if data.get('template') == "AI-generated":
+            return [clean_text(fill_student_placeholders(content, student)) for student in students]
+        return [
+            clean_text(template.format(**{**template_data, 'user': student['name'], 'year_of_study': student['year']}))
+            for student in students
+        ]
 
     letter_content = letter_content.split("\n\nStudent Details:")[0]
 
-    output_file = f"{data['user'].replace(' ', '_')}_leave_letter.pdf"
-    pdf_data = pdf.output(dest='S').encode('latin1')
-
     # Store everything in session state
     if 'pdf_generated' not in st.session_state:
-        st.session_state.pdf_data = pdf_data
-        st.session_state.pdf_filename = output_file
+        st.session_state.pdf_data, st.session_state.pdf_filename = build_letter_output(
+            letter_content,
+            data,
+            signature_path,
+            get_student_letters(letter_content)
+        )
+        st.session_state.letter_content = letter_content
+        st.session_state.signature_path = signature_path
         st.session_state.user_data = data
         st.session_state.pdf_generated = True
         st.session_state.generation_time = time()
@@ -568,9 +1077,10 @@ def generate_leave_letter(data, templates, faculty_df, signature_path=None):
             "📥 Download Letter",
             st.session_state.pdf_data,
             file_name=st.session_state.pdf_filename,
-            mime="application/pdf",
+            mime="application/zip" if st.session_state.pdf_filename.endswith(".zip") else "application/pdf",
             key="download_btn"
         )
+        st.caption(f"📄 {st.session_state.pdf_filename} ({format_size(len(st.session_state.pdf_data))})")
     
     with col2:
         if st.button("📧 Send to Copy Shop", key="email_btn"):
@@ -589,68 +1099,21 @@ def generate_leave_letter(data, templates, faculty_df, signature_path=None):
     if data.get('template') == "AI-generated":
         with col3:
             if st.button("🔄 Regenerate Letter", key="regenerate_btn"):
-                new_letter_content = generate_ai_leave_letter(data, faculty_df)
-                
-                # Create new PDF with the regenerated content
-                pdf = FPDF()
-                pdf.add_page()
-                pdf.set_font("Arial", size=12)
-                pdf.multi_cell(0, 8, clean_text(new_letter_content))
-                
-                # Add table if there are additional students
-                if 'additional_students' in data:
-                    pdf.ln(10)  
-                    pdf.set_font("Arial", 'B', 12)
-                    pdf.cell(0, 10, "Student Details:", ln=True)
-                    pdf.ln(5)
-                    
-                    # Table settings
-                    col_widths = [70, 60, 60]
-                    row_height = 10
-                    
-                    pdf.set_font("Arial", 'B', 10)
-                    pdf.set_fill_color(200, 200, 200)
-                    
-                    pdf.cell(col_widths[0], row_height, "Name", 1, 0, 'C', 1)
-                    pdf.cell(col_widths[1], row_height, "Year of Study", 1, 0, 'C', 1)
-                    pdf.cell(col_widths[2], row_height, "Signature", 1, 1, 'C', 1)
-                    
-                    pdf.set_font("Arial", '', 10)
-                    
-                    pdf.cell(col_widths[0], row_height, data['user'], 1, 0, 'L')
-                    pdf.cell(col_widths[1], row_height, data['year_of_study'], 1, 0, 'C')
-                    sig_cell_y = pdf.get_y()
-                    pdf.cell(col_widths[2], row_height, "", 1, 1, 'C')
-                    
-                    # Add main signature if provided
-                    if signature_path:
-                        signature_img = Image.open(signature_path)
-                        signature_img = signature_img.resize((50, 20), Image.LANCZOS)
-                        temp_path = "temp_signature.png"
-                        signature_img.save(temp_path)
-                        pdf.image(temp_path, x=pdf.get_x() + 145, y=sig_cell_y, w=30, h=8)
-                        os.remove(temp_path)
-                    
-                    # Add additional students
-                    for student in data['additional_students']:
-                        pdf.cell(col_widths[0], row_height, student['name'], 1, 0, 'L')
-                        pdf.cell(col_widths[1], row_height, student['year'], 1, 0, 'C')
-                        sig_cell_y = pdf.get_y()
-                        pdf.cell(col_widths[2], row_height, "", 1, 1, 'C')
-                        
-                        # Add signature if available
-                        if 'additional_signatures' in data and student['name'] in data['additional_signatures']:
-                            sig_path = data['additional_signatures'][student['name']]
-                            if sig_path:
-                                sig_img = Image.open(sig_path)
-                                sig_img = sig_img.resize((50, 20), Image.LANCZOS)
-                                temp_path = f"temp_sig_{student['name']}.png"
-                                sig_img.save(temp_path)
-                                pdf.image(temp_path, x=pdf.get_x() + 145, y=sig_cell_y, w=30, h=8)
-                                os.remove(temp_path)
+                st.session_state.letter_variation = st.session_state.get('letter_variation', 0) + 1
+                if per_student:
+                    new_letter_content = generate_student_letter_template(data, faculty_df, st.session_state.letter_variation)
+                else:
+                    new_letter_content = generate_ai_leave_letter(data, faculty_df, st.session_state.letter_variation)
+                new_letter_content = clean_text(new_letter_content)
                 
                 # Update session state with new PDF
-                st.session_state.pdf_data = pdf.output(dest='S').encode('latin1')
+                st.session_state.pdf_data, st.session_state.pdf_filename = build_letter_output(
+                    new_letter_content,
+                    data,
+                    st.session_state.signature_path,
+                    get_student_letters(new_letter_content)
+                )
+                st.session_state.letter_content = new_letter_content
                 st.rerun()
 
     # timer display
@@ -686,7 +1149,7 @@ def send_to_copy_shop(pdf_data, filename, student_name, department):
         body = f'Please find attached the leave letter for {student_name} from {department}.'
         message.attach(MIMEText(body, 'plain'))
 
-        pdf_attachment = MIMEApplication(pdf_data, _subtype='pdf')
+        pdf_attachment = MIMEApplication(pdf_data, _subtype='zip' if filename.endswith('.zip') else 'pdf')
         pdf_attachment.add_header('Content-Disposition', 'attachment', filename=filename)
         message.attach(pdf_attachment)
 